@@ -1,33 +1,275 @@
-import json
+import hashlib
 import sqlite3
 import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
-from typing import Tuple, Dict
+from typing import Any, Tuple, Dict, List, Optional
+
+import orjson
+import zstandard
+
+# queue.kind / queue.status хранятся как INTEGER: меньше индексные страницы, сравнения — целочисленные.
+# Порядок KIND_* — это приоритет обхода в reserve_next
+KIND_CATALOG, KIND_CATEGORY, KIND_PRODUCT = 0, 1, 2
+STATUS_PENDING, STATUS_DONE, STATUS_ERROR = 0, 1, 2
+# шаг updated_at внутри одного пакета задач: reserve_next (ORDER BY kind, updated_at) берёт их
+# в порядке обнаружения, а не по url из idx_queue_reserve
+QUEUE_TS_STEP = 1e-6
+
+# SQL горячих запросов держим константами: одинаковый текст → подготовленный
+# statement берётся из кэша соединения (cached_statements), без повторного разбора
+SQL_SEED_CATALOG = f"INSERT OR IGNORE INTO queue(url, kind, status, updated_at) VALUES(?, {KIND_CATALOG}, {STATUS_PENDING}, ?)"
+SQL_UPSERT_QUEUE = f"INSERT OR IGNORE INTO queue(url, kind, status, updated_at) VALUES(?, ?, {STATUS_PENDING}, ?)"
+SQL_COUNT_PENDING = f"SELECT COUNT(*) FROM queue WHERE status={STATUS_PENDING}"
+SQL_MARK_DONE = f"UPDATE queue SET status={STATUS_DONE}, updated_at=? WHERE url=?"
+SQL_MARK_ERROR = f"UPDATE queue SET status={STATUS_ERROR}, tries=tries+1, last_error=?, updated_at=? WHERE url=?"
+SQL_UNLOCK = "DELETE FROM locks WHERE url=?"
+SQL_LOCK = "INSERT OR IGNORE INTO locks(url, ts) VALUES(?, ?)"
+# ORDER BY kind, updated_at целиком берётся из idx_queue_reserve, без сортировки во временном B-tree
+SQL_RESERVE_SELECT = f"""
+SELECT q.url, q.kind, pd.category_url,
+       CASE WHEN p.url IS NOT NULL THEN 1 ELSE 0 END AS scraped
+FROM queue q
+LEFT JOIN locks l ON l.url = q.url
+LEFT JOIN product_discovery pd ON pd.url = q.url
+LEFT JOIN products p ON p.url = q.url
+WHERE q.status={STATUS_PENDING}
+  AND l.url IS NULL
+ORDER BY q.kind, q.updated_at
+LIMIT 1
+"""
+SQL_INSERT_CATEGORY = "INSERT OR IGNORE INTO categories(url, name, discovered_at) VALUES(?,?,?)"
+# ссылки со страницы категории: сначала во временную staging_pd, затем двумя INSERT ... SELECT
+SQL_STAGE_PRODUCT = "INSERT OR IGNORE INTO staging_pd(url, title, category_url) VALUES(?,?,?)"
+SQL_MERGE_STAGED_DISCOVERY = """
+INSERT OR IGNORE INTO product_discovery(url, title, category_url, discovered_at)
+SELECT url, title, category_url, ? FROM staging_pd
+"""
+# rowid staging_pd идёт в порядке вставки → updated_at сохраняет порядок ссылок на странице
+SQL_MERGE_STAGED_QUEUE = f"""
+INSERT OR IGNORE INTO queue(url, kind, status, updated_at)
+SELECT url, {KIND_PRODUCT}, {STATUS_PENDING}, ? + rowid * ? FROM staging_pd ORDER BY rowid
+"""
+SQL_CLEAR_STAGING = "DELETE FROM staging_pd"
+SQL_UPSERT_PRODUCT = """
+INSERT INTO products(
+    url, title, price, currency, part_number, brand, stock,
+    prod_id, app_id, alt_sku, category_url,
+    attrs_json, fitment_json, attrs_zst, fitment_zst, payload_hash, discovered_at, scraped_at
+) VALUES (
+    :url, :title, :price, :currency, :part_number, :brand, :stock,
+    :prod_id, :app_id, :alt_sku, :category_url,
+    :attrs_json, :fitment_json, :attrs_zst, :fitment_zst, :payload_hash, :discovered_at, :scraped_at
+)
+ON CONFLICT(url) DO UPDATE SET
+    title=excluded.title,
+    price=excluded.price,
+    currency=excluded.currency,
+    part_number=excluded.part_number,
+    brand=excluded.brand,
+    stock=excluded.stock,
+    prod_id=excluded.prod_id,
+    app_id=excluded.app_id,
+    alt_sku=excluded.alt_sku,
+    category_url=excluded.category_url,
+    attrs_json=excluded.attrs_json,
+    fitment_json=excluded.fitment_json,
+    attrs_zst=excluded.attrs_zst,
+    fitment_zst=excluded.fitment_zst,
+    payload_hash=excluded.payload_hash,
+    scraped_at=excluded.scraped_at
+"""
+# колонки, сравниваемые при повторном парсинге; attrs/fitment — через payload_hash
+PRODUCT_DIFF_COLUMNS = (
+    "title", "price", "currency", "part_number", "brand", "stock",
+    "prod_id", "app_id", "alt_sku", "category_url", "payload_hash",
+)
+SQL_PRODUCT_CURRENT = f"SELECT {', '.join(PRODUCT_DIFF_COLUMNS)} FROM products WHERE url=?"
+SQL_CATEGORY_COUNT = f"SELECT COUNT(*) FROM queue WHERE kind={KIND_CATEGORY}"
+SQL_CATEGORY_COUNT_STATUS = f"SELECT COUNT(*) FROM queue WHERE kind={KIND_CATEGORY} AND status=?"
+# «Пустой» товар (см. repair.py). Текст условия должен совпадать в индексе и в запросе —
+# только тогда планировщик SQLite выбирает частичный индекс
+EMPTY_PRODUCT_WHERE = """
+    (title IS NULL OR trim(title) = '' OR title IN ('USD','EUR','GBP'))
+    OR (
+        price IS NULL
+        AND IFNULL(trim(part_number),'') = ''
+        AND IFNULL(trim(brand),'') = ''
+        AND attrs_zst IS NULL
+        AND (attrs_json IS NULL OR attrs_json = '' OR attrs_json = '{}')
+    )
+"""
+# без IF NOT EXISTS: ensure_index() сравнивает этот текст с sqlite_master и пересоздаёт устаревший индекс
+SQL_CREATE_EMPTY_PRODUCTS_INDEX = f"CREATE INDEX idx_products_empty ON products(url) WHERE {EMPTY_PRODUCT_WHERE}"
+SQL_FIND_EMPTY_PRODUCTS = f"SELECT url FROM products WHERE {EMPTY_PRODUCT_WHERE}"
+
+SQL_CREATE_QUEUE = f"""
+CREATE TABLE IF NOT EXISTS queue (
+    url TEXT PRIMARY KEY,
+    kind INTEGER CHECK(kind IN ({KIND_CATALOG},{KIND_CATEGORY},{KIND_PRODUCT})) NOT NULL,
+    status INTEGER CHECK(status IN ({STATUS_PENDING},{STATUS_DONE},{STATUS_ERROR})) NOT NULL DEFAULT {STATUS_PENDING},
+    tries INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    updated_at REAL
+)
+"""
+
+# Вторичные индексы по таблицам; на время массовой загрузки в таблицу их снимает bulk_indexes()
+SECONDARY_INDEXES = {
+    "queue": {
+        # (status, kind, updated_at) покрывает и reserve_next, и выборки по status
+        "idx_queue_reserve": "CREATE INDEX IF NOT EXISTS idx_queue_reserve ON queue(status, kind, updated_at, url)",
+        "idx_queue_kind_status": "CREATE INDEX IF NOT EXISTS idx_queue_kind_status ON queue(kind, status)",
+    },
+    "product_discovery": {
+        "idx_pd_category": "CREATE INDEX IF NOT EXISTS idx_pd_category ON product_discovery(category_url, url)",
+    },
+}
+
+SQL_PRODUCT_COUNTS = f"""
+SELECT COUNT(*),
+       IFNULL(SUM(q.status={STATUS_DONE}), 0),
+       IFNULL(SUM(q.status={STATUS_PENDING}), 0),
+       IFNULL(SUM(q.status={STATUS_ERROR}), 0)
+FROM product_discovery p
+LEFT JOIN queue q ON q.url = p.url AND q.kind={KIND_PRODUCT}
+WHERE p.category_url=?
+"""
+
+
+# attrs/fitment хранятся как zstd-сжатый компактный JSON (BLOB); пустые — NULL
+_zstd_c = zstandard.ZstdCompressor(level=3)
+_zstd_d = zstandard.ZstdDecompressor()
+
+
+def decode_payload(blob: Optional[bytes], legacy_json: Optional[str], default: Any) -> Any:
+    # attrs_zst/fitment_zst → объект; для строк, записанных до сжатия, — старый attrs_json/fitment_json
+    if blob is not None:
+        return orjson.loads(_zstd_d.decompress(blob))
+    if legacy_json:
+        return orjson.loads(legacy_json)
+    return default
+
+
+def queue_uses_text_enums(conn: sqlite3.Connection) -> bool:
+    # база, созданная до перехода kind/status на INTEGER
+    cols = {r[1]: r[2] for r in conn.execute("PRAGMA table_info(queue)")}
+    return cols.get("kind", "").upper() == "TEXT"
+
+
+def migrate_queue_enums(conn: sqlite3.Connection) -> bool:
+    # одноразово при открытии старой базы (DB._init): queue.kind/status из TEXT в INTEGER
+    if not queue_uses_text_enums(conn):
+        return False
+    conn.execute("BEGIN IMMEDIATE;")
+    conn.execute("ALTER TABLE queue RENAME TO queue_text")
+    conn.execute(SQL_CREATE_QUEUE)
+    conn.execute(f"""
+        INSERT INTO queue(url, kind, status, tries, last_error, updated_at)
+        SELECT url,
+               CASE kind WHEN 'catalog' THEN {KIND_CATALOG} WHEN 'category' THEN {KIND_CATEGORY} ELSE {KIND_PRODUCT} END,
+               CASE status WHEN 'done' THEN {STATUS_DONE} WHEN 'error' THEN {STATUS_ERROR} ELSE {STATUS_PENDING} END,
+               tries, last_error, updated_at
+          FROM queue_text
+    """)
+    # индексы ушли вместе с queue_text
+    conn.execute("DROP TABLE queue_text")
+    for sql in SECONDARY_INDEXES["queue"].values():
+        conn.execute(sql)
+    conn.commit()
+    conn.execute("ANALYZE queue")
+    return True
+
+
+@contextmanager
+def bulk_indexes(conn: sqlite3.Connection, *tables: str):
+    # индексы загружаемых таблиц строятся заново одним проходом после загрузки,
+    # а не обновляются на каждой вставке; индексы остальных таблиц не трогаем
+    for table in tables:
+        for name in SECONDARY_INDEXES[table]:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+    try:
+        yield
+    finally:
+        for table in tables:
+            for sql in SECONDARY_INDEXES[table].values():
+                conn.execute(sql)
+            conn.execute(f"ANALYZE {table}")
+
+
+def ensure_index(conn: sqlite3.Connection, name: str, sql: str):
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type='index' AND name=?", (name,)).fetchone()
+    if row is not None and row[0] == sql:
+        return
+    conn.execute(f"DROP INDEX IF EXISTS {name}")
+    conn.execute(sql)
+
+
+# общие для парсера и repair.py
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA busy_timeout = 5000;",
+    "PRAGMA cache_size = -65536;",       # 64 MiB
+    "PRAGMA mmap_size = 268435456;",     # 256 MiB
+    "PRAGMA wal_autocheckpoint = 1000;",
+)
+
+# id воркера текущей asyncio-задачи: по нему выбирается читающее соединение
+_worker_id: ContextVar[int] = ContextVar("db_worker_id", default=0)
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    # isolation_level=None: никаких неявных BEGIN от sqlite3, транзакции только через transaction()
+    conn = sqlite3.connect(path, cached_statements=256, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
 
 class DB:
     def __init__(self, path: Path):
-        self.conn = sqlite3.connect(path)
-        self.conn.row_factory = sqlite3.Row
-        self.conn.execute("PRAGMA journal_mode = WAL;")
-        self.conn.execute("PRAGMA synchronous = NORMAL;")
-        self.conn.execute("PRAGMA temp_store = MEMORY;")
+        self.path = path
+        # все изменения — через одно пишущее соединение, SELECT-ы — через читающее соединение воркера (WAL)
+        self._write_conn = _connect(path)
+        self._cur = self._write_conn.cursor()
+        self._local: Dict[int, sqlite3.Cursor] = {}
         self._init()
 
+    def bind_worker(self, wid: int):
+        _worker_id.set(wid)
+
+    def _read_cur(self) -> sqlite3.Cursor:
+        wid = _worker_id.get()
+        cur = self._local.get(wid)
+        if cur is None:
+            conn = _connect(self.path)
+            conn.execute("PRAGMA query_only = ON;")
+            cur = self._local[wid] = conn.cursor()
+        return cur
+
+    def analyze(self):
+        # статистика sqlite_stat1 для планировщика: выбор idx_queue_reserve/idx_pd_category на перекошенных данных
+        for table in ("queue", "product_discovery", "products"):
+            self._write_conn.execute(f"ANALYZE {table}")
+
+    def close(self):
+        self._write_conn.execute("PRAGMA analysis_limit = 1000;")
+        self._write_conn.execute("PRAGMA optimize;")
+        for cur in self._local.values():
+            cur.connection.close()
+        self._local.clear()
+        self._write_conn.close()
+
     def _init(self):
-        cur = self.conn.cursor()
+        cur = self._write_conn.cursor()
         # Очередь обхода
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS queue (
-            url TEXT PRIMARY KEY,
-            kind TEXT CHECK(kind IN ('catalog','category','product')) NOT NULL,
-            status TEXT CHECK(status IN ('pending','done','error')) NOT NULL DEFAULT 'pending',
-            tries INTEGER NOT NULL DEFAULT 0,
-            last_error TEXT,
-            updated_at REAL
-        );
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_queue_status ON queue(status);")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_queue_kind_status ON queue(kind, status);")
+        migrate_queue_enums(self._write_conn)
+        cur.execute(SQL_CREATE_QUEUE)
+        cur.execute("DROP INDEX IF EXISTS idx_queue_status;")
 
         # Категории
         cur.execute("""
@@ -64,10 +306,20 @@ class DB:
             category_url TEXT,
             attrs_json TEXT,
             fitment_json TEXT,
+            attrs_zst BLOB,
+            fitment_zst BLOB,
+            payload_hash TEXT,
             discovered_at REAL,
             scraped_at REAL
         );
         """)
+        self._ensure_column("products", "payload_hash", "TEXT")
+        self._ensure_column("products", "attrs_zst", "BLOB")
+        self._ensure_column("products", "fitment_zst", "BLOB")
+        ensure_index(self._write_conn, "idx_products_empty", SQL_CREATE_EMPTY_PRODUCTS_INDEX)
+        for indexes in SECONDARY_INDEXES.values():
+            for sql in indexes.values():
+                cur.execute(sql)
 
         # Замки для конкурентной выборки задач
         cur.execute("""
@@ -76,156 +328,151 @@ class DB:
             ts REAL
         );
         """)
-        self.conn.commit()
+
+        # Буфер ссылок со страницы категории (temp — только у пишущего соединения, в памяти)
+        cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS staging_pd (
+            url TEXT PRIMARY KEY,
+            title TEXT,
+            category_url TEXT
+        );
+        """)
+
+    def _ensure_column(self, table: str, column: str, decl: str):
+        cols = {r["name"] for r in self._write_conn.execute(f"PRAGMA table_info({table})")}
+        if column not in cols:
+            self._write_conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
 
     def _ts(self) -> float:
         return time.time()
 
+    @contextmanager
+    def transaction(self):
+        # одиночные insert/upsert вне transaction() коммитятся сразу (autocommit);
+        # вложенный вызов просто присоединяется к уже открытой транзакции
+        if self._write_conn.in_transaction:
+            yield
+            return
+        self._cur.execute("BEGIN IMMEDIATE;")
+        try:
+            yield
+        except BaseException:
+            self._cur.execute("ROLLBACK;")
+            raise
+        self._cur.execute("COMMIT;")
+
     # очередь
     def seed_catalog(self, url: str):
-        self.conn.execute(
-            "INSERT OR IGNORE INTO queue(url, kind, status, updated_at) VALUES(?, 'catalog', 'pending', ?)",
-            (url, self._ts()),
-        )
-        self.conn.commit()
-
-    def upsert_queue(self, url: str, kind: str):
-        self.conn.execute(
-            "INSERT OR IGNORE INTO queue(url, kind, status, updated_at) VALUES(?, ?, 'pending', ?)",
-            (url, kind, self._ts()),
-        )
-        self.conn.commit()
+        self._cur.execute(SQL_SEED_CATALOG, (url, self._ts()))
+
+    def upsert_queue_many(self, rows: List[Tuple[str, int]]):
+        ts = self._ts()
+        with self.transaction():
+            self._cur.executemany(
+                SQL_UPSERT_QUEUE, [(url, kind, ts + i * QUEUE_TS_STEP) for i, (url, kind) in enumerate(rows)]
+            )
 
     def count_pending(self) -> int:
-        (n,) = self.conn.execute("SELECT COUNT(*) FROM queue WHERE status='pending'").fetchone()
+        (n,) = self._read_cur().execute(SQL_COUNT_PENDING).fetchone()
         return int(n)
 
     def mark_done(self, url: str):
-        self.conn.execute(
-            "UPDATE queue SET status='done', updated_at=? WHERE url=?",
-            (self._ts(), url)
-        )
-        self.conn.execute("DELETE FROM locks WHERE url=?", (url,))
-        self.conn.commit()
+        with self.transaction():
+            self._cur.execute(SQL_MARK_DONE, (self._ts(), url))
+            self._cur.execute(SQL_UNLOCK, (url,))
 
     def mark_error(self, url: str, err: str):
-        self.conn.execute(
-            "UPDATE queue SET status='error', tries=tries+1, last_error=?, updated_at=? WHERE url=?",
-            (err[:1000], self._ts(), url)
-        )
-        self.conn.execute("DELETE FROM locks WHERE url=?", (url,))
-        self.conn.commit()
+        with self.transaction():
+            self._cur.execute(SQL_MARK_ERROR, (err[:1000], self._ts(), url))
+            self._cur.execute(SQL_UNLOCK, (url,))
 
     def reserve_next(self):
-        cur = self.conn.cursor()
-        cur.execute("BEGIN IMMEDIATE;")
-        row = cur.execute("""
-            SELECT url, kind FROM queue
-            WHERE status='pending'
-              AND url NOT IN (SELECT url FROM locks)
-            ORDER BY CASE kind WHEN 'catalog' THEN 0 WHEN 'category' THEN 1 ELSE 2 END,
-                     updated_at ASC
-            LIMIT 1;
-        """).fetchone()
-        if not row:
-            self.conn.execute("COMMIT;")
-            return None
-        url = row["url"]
-        cur.execute("INSERT OR IGNORE INTO locks(url, ts) VALUES(?, ?)", (url, self._ts()))
-        self.conn.execute("COMMIT;")
-        return (row["url"], row["kind"])
+        # выборка и постановка замка — в одной пишущей транзакции, иначе два воркера возьмут один url
+        with self.transaction():
+            row = self._cur.execute(SQL_RESERVE_SELECT).fetchone()
+            if not row:
+                return None
+            self._cur.execute(SQL_LOCK, (row["url"], self._ts()))
+        # (url, kind, category_url, scraped) — категория и признак «уже спарсен» для product
+        return (row["url"], row["kind"], row["category_url"], bool(row["scraped"]))
 
     # категории/продукты
-    def insert_category(self, url: str, name: str):
-        self.conn.execute(
-            "INSERT OR IGNORE INTO categories(url, name, discovered_at) VALUES(?,?,?)",
-            (url, name, self._ts())
-        )
-        self.conn.commit()
-
-    def insert_product_discovery(self, url: str, title: str, category_url: str):
-        self.conn.execute(
-            "INSERT OR IGNORE INTO product_discovery(url, title, category_url, discovered_at) VALUES(?,?,?,?)",
-            (url, title, category_url, self._ts())
-        )
-        self.conn.commit()
-
-    def product_exists(self, url: str) -> bool:
-        row = self.conn.execute("SELECT 1 FROM products WHERE url=? LIMIT 1", (url,)).fetchone()
-        return bool(row)
+    def insert_categories_many(self, rows: List[Tuple[str, str]]):
+        ts = self._ts()
+        with self.transaction():
+            self._cur.executemany(SQL_INSERT_CATEGORY, [(url, name, ts) for url, name in rows])
+
+    def discover_products_many(self, rows: List[Tuple[str, str, str]]):
+        # rows: (url, title, category_url) → product_discovery + queue(KIND_PRODUCT) одной транзакцией
+        ts = self._ts()
+        with self.transaction():
+            self._cur.executemany(SQL_STAGE_PRODUCT, rows)
+            self._cur.execute(SQL_MERGE_STAGED_DISCOVERY, (ts,))
+            self._cur.execute(SQL_MERGE_STAGED_QUEUE, (ts, QUEUE_TS_STEP))
+            self._cur.execute(SQL_CLEAR_STAGING)
+
+    def _product_values(self, data: dict) -> dict:
+        attrs = data.get("attrs") or {}
+        fitment = data.get("fitment") or []
+        # orjson сразу отдаёт компактный UTF-8 (как json.dumps с ensure_ascii=False и без пробелов)
+        attrs_raw = orjson.dumps(attrs)
+        fitment_raw = orjson.dumps(fitment)
+        payload_hash = hashlib.blake2b(attrs_raw + b"\0" + fitment_raw, digest_size=16).hexdigest()
+        return {
+            "url": data.get("url"),
+            "title": data.get("title"),
+            "price": data.get("price"),
+            "currency": data.get("currency"),
+            "part_number": data.get("part_number"),
+            "brand": data.get("brand"),
+            "stock": data.get("stock"),
+            "prod_id": data.get("prod_id"),
+            "app_id": data.get("app_id"),
+            "alt_sku": data.get("alt_sku"),
+            "category_url": data.get("category_url"),
+            "attrs_json": None,
+            "fitment_json": None,
+            "attrs_zst": _zstd_c.compress(attrs_raw) if attrs else None,
+            "fitment_zst": _zstd_c.compress(fitment_raw) if fitment else None,
+            "payload_hash": payload_hash,
+            "discovered_at": data.get("discovered_at") or self._ts(),
+            "scraped_at": data.get("scraped_at") or self._ts(),
+        }
+
+    def _product_changes(self, values: dict) -> Optional[List[str]]:
+        # None — товара ещё нет; иначе колонки, которые надо переписать (пусто — ничего не изменилось)
+        row = self._cur.execute(SQL_PRODUCT_CURRENT, (values["url"],)).fetchone()
+        if row is None:
+            return None
+        changed = [c for c in PRODUCT_DIFF_COLUMNS if row[c] != values[c]]
+        if "payload_hash" in changed:
+            # старые текстовые колонки обнуляем — данные теперь в *_zst
+            changed += ["attrs_zst", "fitment_zst", "attrs_json", "fitment_json"]
+        return changed
+
+    def _update_product(self, values: dict, changed: List[str]):
+        # большие JSON переписываются только если изменился payload_hash; без изменений — UPDATE не делаем
+        if changed:
+            sets = ", ".join(f"{c}=:{c}" for c in changed + ["scraped_at"])
+            self._cur.execute(f"UPDATE products SET {sets} WHERE url=:url", values)
 
     def upsert_product(self, data: dict):
-        self.conn.execute("""
-        INSERT INTO products(
-            url, title, price, currency, part_number, brand, stock,
-            prod_id, app_id, alt_sku, category_url,
-            attrs_json, fitment_json, discovered_at, scraped_at
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        ON CONFLICT(url) DO UPDATE SET
-            title=excluded.title,
-            price=excluded.price,
-            currency=excluded.currency,
-            part_number=excluded.part_number,
-            brand=excluded.brand,
-            stock=excluded.stock,
-            prod_id=excluded.prod_id,
-            app_id=excluded.app_id,
-            alt_sku=excluded.alt_sku,
-            category_url=excluded.category_url,
-            attrs_json=excluded.attrs_json,
-            fitment_json=excluded.fitment_json,
-            scraped_at=excluded.scraped_at;
-        """, (
-            data.get("url"),
-            data.get("title"),
-            data.get("price"),
-            data.get("currency"),
-            data.get("part_number"),
-            data.get("brand"),
-            data.get("stock"),
-            data.get("prod_id"),
-            data.get("app_id"),
-            data.get("alt_sku"),
-            data.get("category_url"),
-            json.dumps(data.get("attrs") or {}, ensure_ascii=False),
-            json.dumps(data.get("fitment") or [], ensure_ascii=False),
-            data.get("discovered_at") or self._ts(),
-            data.get("scraped_at") or self._ts(),
-        ))
-        self.conn.commit()
+        values = self._product_values(data)
+        changed = self._product_changes(values)
+        if changed is None:
+            self._cur.execute(SQL_UPSERT_PRODUCT, values)
+        else:
+            self._update_product(values, changed)
 
     # Прогресс
     def category_counts(self) -> Dict[str, int]:
-        (total,)  = self.conn.execute("SELECT COUNT(*) FROM queue WHERE kind='category'").fetchone()
-        (done,)   = self.conn.execute("SELECT COUNT(*) FROM queue WHERE kind='category' AND status='done'").fetchone()
-        (pend,)   = self.conn.execute("SELECT COUNT(*) FROM queue WHERE kind='category' AND status='pending'").fetchone()
-        (error,)  = self.conn.execute("SELECT COUNT(*) FROM queue WHERE kind='category' AND status='error'").fetchone()
+        cur = self._read_cur()
+        (total,) = cur.execute(SQL_CATEGORY_COUNT).fetchone()
+        (done,)  = cur.execute(SQL_CATEGORY_COUNT_STATUS, (STATUS_DONE,)).fetchone()
+        (pend,)  = cur.execute(SQL_CATEGORY_COUNT_STATUS, (STATUS_PENDING,)).fetchone()
+        (error,) = cur.execute(SQL_CATEGORY_COUNT_STATUS, (STATUS_ERROR,)).fetchone()
         return {"total": int(total), "done": int(done), "pending": int(pend), "error": int(error)}
 
     def product_counts_for_category(self, category_url: str) -> Dict[str, int]:
-        (total,) = self.conn.execute(
-            "SELECT COUNT(*) FROM product_discovery WHERE category_url=?",
-            (category_url,)
-        ).fetchone()
-        (done,) = self.conn.execute(
-            """
-            SELECT COUNT(*) FROM queue
-            WHERE kind='product' AND status='done'
-              AND url IN (SELECT url FROM product_discovery WHERE category_url=?)
-            """, (category_url,)
-        ).fetchone()
-        (pend,) = self.conn.execute(
-            """
-            SELECT COUNT(*) FROM queue
-            WHERE kind='product' AND status='pending'
-              AND url IN (SELECT url FROM product_discovery WHERE category_url=?)
-            """, (category_url,)
-        ).fetchone()
-        (error,) = self.conn.execute(
-            """
-            SELECT COUNT(*) FROM queue
-            WHERE kind='product' AND status='error'
-              AND url IN (SELECT url FROM product_discovery WHERE category_url=?)
-            """, (category_url,)
-        ).fetchone()
+        total, done, pend, error = self._read_cur().execute(SQL_PRODUCT_COUNTS, (category_url,)).fetchone()
         return {"total": int(total), "done": int(done), "pending": int(pend), "error": int(error)}
@@ -2,17 +2,22 @@ import asyncio
 import random
 import re
 import time
+from functools import lru_cache
 from pathlib import Path
 from urllib.parse import urljoin, urlsplit, urlunsplit
 
+from aiolimiter import AsyncLimiter
 from patchright.async_api import async_playwright
-from db import DB
+from selectolax.lexbor import LexborHTMLParser
+from db import DB, KIND_CATALOG, KIND_CATEGORY, KIND_PRODUCT
 
 DB_PATH = Path("partsgeek.sqlite3")
 
 CATALOG_URL = "https://www.partsgeek.com/catalog/"
 
 MAX_WORKERS = 5
+# общий бюджет запросов к сайту на все воркеры (навигаций в секунду)
+MAX_RPS = 10
 
 NAV_TIMEOUT_MS = 20000
 READY_SEL_TIMEOUT_MS = 7000
@@ -24,8 +29,21 @@ X_NEXT_PAGE = '//*[@id="whole"]//a[@rel="next" or contains(translate(normalize-s
 
 PRODUCT_READY_SEL = ".product-info-container"
 
+PRICE_RE = re.compile(r'([$\€£])?\s*([0-9][0-9\.,]*)')
+STOCK_RE = re.compile(r'\((\d+)\)')
+WS_RE = re.compile(r"\s+")
+CURRENCY_MAP = {"$": "USD", "€": "EUR", "£": "GBP"}
+
+# token bucket вместо фиксированной паузы после каждой страницы: ждёт только тот, кто пришёл раньше бюджета
+RATE_LIMIT = AsyncLimiter(MAX_RPS, 1)
+
+# Ресурсы, которые не нужны для чтения текста со страницы
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+BLOCKED_URL_PARTS = ("googletagmanager", "google-analytics", "doubleclick", "facebook", "hotjar")
+
 
 # Утилиты
+@lru_cache(maxsize=65536)
 def canonicalize_url(url: str) -> str:
     parts = list(urlsplit(url))
     parts[4] = ""
@@ -35,13 +53,23 @@ def canonicalize_url(url: str) -> str:
     return clean
 
 
+async def block_heavy_resources(route):
+    req = route.request
+    if req.resource_type in BLOCKED_RESOURCE_TYPES or any(p in req.url for p in BLOCKED_URL_PARTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
 async def configure_page(page):
     page.set_default_navigation_timeout(NAV_TIMEOUT_MS)
     page.set_default_timeout(READY_SEL_TIMEOUT_MS)
+    await page.route("**/*", block_heavy_resources)
 
 
 async def goto(page, url: str, *, ready_selector: str | None = None,
-               sleep_after_ms: tuple[int, int] = (200, 400)):
+               sleep_after_ms: tuple[int, int] = (50, 100)):
+    await RATE_LIMIT.acquire()
     print(f"[i] → {url}")
     await page.goto(url, wait_until="load")  # ключевая смена: БЕЗ networkidle
 
@@ -81,44 +109,88 @@ def parse_price_to_float(text: str | None):
     if not text:
         return None, None
     t = text.strip()
-    m = re.search(r'([$\€£])?\s*([0-9][0-9\.,]*)', t)
+    # частый случай "$123.45" — без регулярки; только ASCII-цифры и не больше одной точки,
+    # иначе float() принял бы то, что регулярка не берёт ("1e5", "1_000", не-ASCII цифры)
+    if t.startswith("$"):
+        raw = t[1:].replace(",", "")
+        if raw.isascii() and raw[:1].isdigit() and raw.replace(".", "", 1).isdigit():
+            return float(raw), "USD"
+    m = PRICE_RE.search(t)
     if not m:
         return None, None
     currency_symbol = (m.group(1) or "$").strip()
     raw = m.group(2).replace(",", "")
     try:
-        return float(raw), {"$": "USD", "€": "EUR", "£": "GBP"}.get(currency_symbol, "USD")
+        return float(raw), CURRENCY_MAP.get(currency_symbol, "USD")
     except Exception:
         return None, None
 
 
-async def get_text(page, selector: str):
-    el = await page.query_selector(selector)
-    if not el:
+# Карточка товара разбирается локально из page.content(): Playwright нужен только
+# для навигации и ожидания готовности, а не для каждого селектора
+TEXT_SKIP_TAGS = {"script", "style", "template", "noscript", "-comment"}
+TEXT_BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "dd", "div", "dl", "dt", "fieldset",
+    "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6",
+    "header", "hr", "li", "main", "nav", "ol", "p", "pre", "section", "table",
+    "tbody", "tfoot", "thead", "tr", "ul",
+}
+
+
+def _collect_text(node, parts: list):
+    for child in node.iter(include_text=True):
+        tag = child.tag
+        if tag == "-text":
+            # перевод строки в исходнике — обычный пробел, строки рвут только <br> и блоки
+            parts.append(WS_RE.sub(" ", child.text_content or ""))
+        elif tag == "br":
+            parts.append("\n")
+        elif tag in TEXT_SKIP_TAGS:
+            continue
+        elif tag in TEXT_BLOCK_TAGS:
+            parts.append("\n")
+            _collect_text(child, parts)
+            parts.append("\n")
+        else:
+            # ячейки в innerText разделяются табом — после схлопывания это пробел
+            if tag in ("td", "th"):
+                parts.append(" ")
+            _collect_text(child, parts)
+
+
+def node_text(node) -> str:
+    # приближение innerText: <br> и блочные теги дают перевод строки, script/style
+    # пропускаются, внутри строки пробелы схлопываются, пустые строки выкидываются
+    parts = []
+    _collect_text(node, parts)
+    lines = (" ".join(line.split()) for line in "".join(parts).split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def get_text(tree, selector: str):
+    node = tree.css_first(selector)
+    if node is None:
         return None
-    return (await el.inner_text() or "").strip()
+    return node_text(node)
 
 
-async def extract_attr_block(page):
+def extract_attr_block(tree):
     attrs = {}
-    rows = await page.query_selector_all(
+    rows = tree.css(
         ".product-info-container .product-info .product-attributes > div, "
         ".product-info-container .product-info .product-attributes-red-bold > div, "
         ".product-info-container .product-info > div"
     )
     for row in rows:
-        head_el = await row.query_selector(".product-attribute-heading")
-        if not head_el:
+        head_el = row.css_first(".product-attribute-heading")
+        if head_el is None:
             continue
-        key = (await head_el.inner_text() or "").strip()
-        key = key.rstrip(":").strip()
-        val_el = await row.query_selector(".product-attribute-content")
-        if val_el:
-            val = (await val_el.inner_text() or "").strip()
+        key = node_text(head_el).rstrip(":").strip()
+        val_el = row.css_first(".product-attribute-content")
+        if val_el is not None:
+            val = node_text(val_el)
         else:
-            full = (await row.inner_text()) or ""
-            full = full.strip()
-            val = full
+            val = node_text(row)
             if val.lower().startswith((key + ":").lower()):
                 val = val[len(key) + 1:].strip()
         if key:
@@ -136,15 +208,10 @@ async def click_fitment_show_more_if_present(page):
             pass
 
 
-async def extract_fitment_table(page):
-    await click_fitment_show_more_if_present(page)
-    rows = await page.query_selector_all(".fitment-container .applications-container table tbody tr")
+def extract_fitment_table(tree):
     res = []
-    for r in rows:
-        tds = await r.query_selector_all("td.application-content")
-        vals = []
-        for td in tds:
-            vals.append(((await td.inner_text()) or "").strip())
+    for r in tree.css(".fitment-container .applications-container table tbody tr"):
+        vals = [node_text(td) for td in r.css("td.application-content")]
         vehicle = vals[0] if len(vals) > 0 else None
         sub_model = vals[1] if len(vals) > 1 else None
         engine = vals[2] if len(vals) > 2 else None
@@ -153,12 +220,12 @@ async def extract_fitment_table(page):
     return res
 
 
-async def extract_hidden_inputs(page):
+def extract_hidden_inputs(tree):
     data = {}
     for name in ["prod_id", "app_id", "alt_sku", "part_number"]:
-        el = await page.query_selector(f'form.product-form input[name="{name}"]')
-        if el:
-            data[name] = await el.get_attribute("value")
+        el = tree.css_first(f'form.product-form input[name="{name}"]')
+        if el is not None:
+            data[name] = el.attributes.get("value")
     return data
 
 
@@ -168,12 +235,11 @@ async def parse_catalog(db: DB, page, url: str):
     links = await extract_links(page, X_CATALOG_LINKS)
     print(f"[✓] Категорий найдено: {len(links)}")
 
-    for href, name in links:
-        abs_url = canonicalize_url(urljoin(url, href))
-        db.insert_category(abs_url, name)
-        db.upsert_queue(abs_url, "category")
-
-    db.mark_done(url)
+    categories = [(canonicalize_url(urljoin(url, href)), name) for href, name in links]
+    with db.transaction():
+        db.insert_categories_many(categories)
+        db.upsert_queue_many([(abs_url, KIND_CATEGORY) for abs_url, _ in categories])
+        db.mark_done(url)
 
 
 async def parse_category(db: DB, page, url: str):
@@ -190,10 +256,9 @@ async def parse_category(db: DB, page, url: str):
         total_found_in_category += len(prods)
         print(f"[✓] Товаров на странице {page_num}: {len(prods)} (accum: {total_found_in_category})")
 
-        for href, title in prods:
-            abs_url = canonicalize_url(urljoin(cur_url, href))
-            db.insert_product_discovery(abs_url, title, url)
-            db.upsert_queue(abs_url, "product")
+        db.discover_products_many([
+            (canonicalize_url(urljoin(cur_url, href)), title, url) for href, title in prods
+        ])
 
         next_rel = await find_next_page(page)
         if not next_rel:
@@ -205,10 +270,24 @@ async def parse_category(db: DB, page, url: str):
 
     cat_counts = db.category_counts()
     print(f"[cat {cat_counts['done']}/{cat_counts['total']} done] {url}")
+    if cat_counts["pending"] == 0:
+        # обход категорий закончен: queue/product_discovery заполнены — обновляем статистику
+        db.analyze()
 
 
-async def parse_product(db: DB, page, url: str, *, category_url: str | None = None):
-    if db.product_exists(url):
+async def open_product(page, url: str) -> bool:
+    await goto(page, url, ready_selector=PRODUCT_READY_SEL)
+    try:
+        await page.wait_for_selector(PRODUCT_READY_SEL, timeout=2000)
+    except Exception:
+        return False
+    return True
+
+
+async def parse_product(db: DB, page, url: str, *, category_url: str | None = None,
+                        scraped: bool = False, loading: asyncio.Task | None = None):
+    # loading — уже запущенный open_product(page, url) (см. worker), иначе грузим здесь
+    if scraped:
         db.mark_done(url)
         if category_url:
             pc = db.product_counts_for_category(category_url)
@@ -219,38 +298,38 @@ async def parse_product(db: DB, page, url: str, *, category_url: str | None = No
         pc = db.product_counts_for_category(category_url)
         print(f"[prod {pc['done'] + 1}/{pc['total']} in cat] → {url}")
 
-    await goto(page, url, ready_selector=PRODUCT_READY_SEL, sleep_after_ms=(200, 400))
-
-    try:
-        await page.wait_for_selector(PRODUCT_READY_SEL, timeout=2000)
-    except Exception:
+    ready = await loading if loading else await open_product(page, url)
+    if not ready:
         db.mark_error(url, "product_container_not_found")
         print(f"[prod error] container not found → skip {url}")
         return
 
-    title = await get_text(page, ".product-info-container .product-title h1")
-    raw_price = await get_text(page, ".product-info-container .product-offer .product-price")
+    await click_fitment_show_more_if_present(page)
+    tree = LexborHTMLParser(await page.content())
+
+    title = get_text(tree, ".product-info-container .product-title h1")
+    raw_price = get_text(tree, ".product-info-container .product-offer .product-price")
     price, currency = parse_price_to_float(raw_price)
 
-    attrs = await extract_attr_block(page)
+    attrs = extract_attr_block(tree)
     part_number = attrs.get("Part Number")
     brand = attrs.get("Brand")
 
-    hidden = await extract_hidden_inputs(page)
+    hidden = extract_hidden_inputs(tree)
     if not part_number:
         part_number = hidden.get("part_number") or hidden.get("alt_sku")
 
-    stock_text = await get_text(page, ".product-info-container .product-stock")
+    stock_text = get_text(tree, ".product-info-container .product-stock")
     stock = None
     if stock_text:
-        m = re.search(r'\((\d+)\)', stock_text)
+        m = STOCK_RE.search(stock_text)
         if m:
             try:
                 stock = int(m.group(1))
             except Exception:
                 pass
 
-    fitment = await extract_fitment_table(page)
+    fitment = extract_fitment_table(tree)
 
     if not title:
         db.mark_error(url, "title_missing")
@@ -273,8 +352,9 @@ async def parse_product(db: DB, page, url: str, *, category_url: str | None = No
         "fitment": fitment,
         "scraped_at": time.time(),
     }
-    db.upsert_product(data)
-    db.mark_done(url)
+    with db.transaction():
+        db.upsert_product(data)
+        db.mark_done(url)
 
     if category_url:
         pc = db.product_counts_for_category(category_url)
@@ -284,32 +364,51 @@ async def parse_product(db: DB, page, url: str, *, category_url: str | None = No
 
 
 # Воркеры
-async def worker(db: DB, page, wid: int):
-    await configure_page(page)
+def reserve_ahead(db: DB, page):
+    # резервируем следующую задачу заранее; карточку товара сразу начинаем грузить во второй вкладке
+    row = db.reserve_next()
+    if not row:
+        return None
+    url, kind, _, scraped = row
+    loading = asyncio.create_task(open_product(page, url)) if kind == KIND_PRODUCT and not scraped else None
+    return row, loading
+
+
+async def worker(db: DB, pages, wid: int):
+    db.bind_worker(wid)
+    for pg in pages:
+        await configure_page(pg)
+    # page — текущая вкладка, spare — в ней грузится следующая карточка, пока разбираем текущую
+    page, spare = pages
 
     idle_rounds = 0
+    ahead = None
     while True:
-        row = db.reserve_next()
-        if not row:
-            if db.count_pending() == 0:
-                return
-            idle_rounds += 1
-            await asyncio.sleep(min(0.5 + idle_rounds * 0.1, 2.0))
-            continue
-
-        url, kind = row
+        if ahead:
+            row, loading = ahead
+            ahead = None
+        else:
+            row, loading = db.reserve_next(), None
+            if not row:
+                if db.count_pending() == 0:
+                    return
+                idle_rounds += 1
+                await asyncio.sleep(min(0.5 + idle_rounds * 0.1, 2.0))
+                continue
+
+        url, kind, category_url, scraped = row
         try:
-            if kind == "catalog":
+            if kind == KIND_CATALOG:
                 await parse_catalog(db, page, url)
-            elif kind == "category":
+            elif kind == KIND_CATEGORY:
                 await parse_category(db, page, url)
-            elif kind == "product":
-                cur = db.conn.execute(
-                    "SELECT category_url FROM product_discovery WHERE url=?",
-                    (url,)
-                ).fetchone()
-                category_url = cur["category_url"] if cur else None
-                await parse_product(db, page, url, category_url=category_url)
+            elif kind == KIND_PRODUCT:
+                if not scraped:
+                    if loading is None:
+                        loading = asyncio.create_task(open_product(page, url))
+                    await asyncio.wait([loading])
+                    ahead = reserve_ahead(db, spare)
+                await parse_product(db, page, url, category_url=category_url, scraped=scraped, loading=loading)
             else:
                 db.mark_error(url, f"Unknown kind: {kind}")
         except Exception as e:
@@ -317,20 +416,26 @@ async def worker(db: DB, page, wid: int):
             db.mark_error(url, repr(e))
             await page.wait_for_timeout(800 + random.randint(0, 400))
 
+        if ahead and ahead[1] is not None:
+            page, spare = spare, page
+
 
 async def main():
     db = DB(DB_PATH)
-    db.seed_catalog(CATALOG_URL)
+    try:
+        db.seed_catalog(CATALOG_URL)
 
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=False)
+        async with async_playwright() as p:
+            browser = await p.chromium.launch(headless=False)
 
-        pages = [await browser.new_page() for _ in range(max(1, MAX_WORKERS))]
-        await asyncio.gather(*(configure_page(pg) for pg in pages))
+            # по две вкладки на воркера: пока одна разбирается, во второй грузится следующая карточка
+            pages = [(await browser.new_page(), await browser.new_page()) for _ in range(max(1, MAX_WORKERS))]
 
-        tasks = [asyncio.create_task(worker(db, page, i)) for i, page in enumerate(pages, start=1)]
-        await asyncio.gather(*tasks)
-        await browser.close()
+            tasks = [asyncio.create_task(worker(db, pair, i)) for i, pair in enumerate(pages, start=1)]
+            await asyncio.gather(*tasks)
+            await browser.close()
+    finally:
+        db.close()
 
 
 if __name__ == "__main__":
@@ -2,35 +2,38 @@
 import sys
 import sqlite3
 import time
+from contextlib import nullcontext
 from pathlib import Path
 
+from db import (
+    DB, KIND_PRODUCT, STATUS_PENDING, STATUS_ERROR,
+    CONNECTION_PRAGMAS, SQL_CREATE_EMPTY_PRODUCTS_INDEX, SQL_FIND_EMPTY_PRODUCTS,
+    bulk_indexes, ensure_index,
+)
+
+# индексы queue снимаем и строим заново, только если ошибок много и это бо́льшая часть таблицы:
+# без idx_queue_reserve выборка status=error идёт полным сканом, а перестройка и ANALYZE
+# проходят по всем строкам — на малой доле это медленнее обычного индексного пути
+BULK_REQUEUE_MIN_ROWS = 50_000
+BULK_REQUEUE_MIN_SHARE = 0.5
+
 
 def now_ts() -> float:
     return time.time()
 
 
 def connect(db_path: Path) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, isolation_level=None)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode = WAL;")
-    conn.execute("PRAGMA synchronous = NORMAL;")
-    conn.execute("PRAGMA temp_store = MEMORY;")
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
 def find_empty_products(conn: sqlite3.Connection) -> list[str]:
-    rows = conn.execute("""
-        SELECT url
-        FROM products
-        WHERE
-            (title IS NULL OR trim(title) = '' OR title IN ('USD','EUR','GBP'))
-            OR (
-                price IS NULL
-                AND IFNULL(trim(part_number),'') = ''
-                AND IFNULL(trim(brand),'') = ''
-                AND (attrs_json IS NULL OR attrs_json = '' OR attrs_json = '{}')
-            )
-    """).fetchall()
+    # условие совпадает с частичным индексом idx_products_empty → читаем только его
+    ensure_index(conn, "idx_products_empty", SQL_CREATE_EMPTY_PRODUCTS_INDEX)
+    rows = conn.execute(SQL_FIND_EMPTY_PRODUCTS).fetchall()
     return [r["url"] for r in rows]
 
 
@@ -42,27 +45,29 @@ def delete_products(conn: sqlite3.Connection, urls: list[str]) -> int:
 
 
 def ensure_queue_pending_for_products(conn: sqlite3.Connection, urls: list[str], ts: float) -> None:
-    for u in urls:
-        conn.execute("""
-            UPDATE queue
-               SET status='pending', tries=0, last_error=NULL, updated_at=?
-             WHERE url=? AND status!='pending'
-        """, (ts, u))
-        conn.execute("""
-            INSERT OR IGNORE INTO queue(url, kind, status, updated_at)
-            VALUES(?, 'product', 'pending', ?)
-        """, (u, ts))
-        conn.execute("DELETE FROM locks WHERE url=?", (u,))
+    if not urls:
+        return
+    # вызывается внутри BEGIN IMMEDIATE из main(): три executemany — одна транзакция
+    conn.executemany(f"""
+        UPDATE queue
+           SET status={STATUS_PENDING}, tries=0, last_error=NULL, updated_at=?
+         WHERE url=? AND status!={STATUS_PENDING}
+    """, [(ts, u) for u in urls])
+    conn.executemany(f"""
+        INSERT OR IGNORE INTO queue(url, kind, status, updated_at)
+        VALUES(?, {KIND_PRODUCT}, {STATUS_PENDING}, ?)
+    """, [(u, ts) for u in urls])
+    conn.executemany("DELETE FROM locks WHERE url=?", [(u,) for u in urls])
 
 
 def requeue_all_errors(conn: sqlite3.Connection, ts: float) -> int:
-    err_rows = conn.execute("SELECT url FROM queue WHERE status='error'").fetchall()
+    err_rows = conn.execute(f"SELECT url FROM queue WHERE status={STATUS_ERROR}").fetchall()
     urls = [r["url"] for r in err_rows]
 
-    conn.execute("""
+    conn.execute(f"""
         UPDATE queue
-           SET status='pending', tries=0, last_error=NULL, updated_at=?
-         WHERE status='error'
+           SET status={STATUS_PENDING}, tries=0, last_error=NULL, updated_at=?
+         WHERE status={STATUS_ERROR}
     """, (ts,))
     if urls:
         conn.executemany("DELETE FROM locks WHERE url=?", [(u,) for u in urls])
@@ -74,6 +79,9 @@ def main():
 
     conn = connect(db_path)
     try:
+        # схема (миграция queue на INTEGER, новые колонки products, индексы) — как при запуске парсера
+        DB(db_path).close()
+
         ts = now_ts()
 
         # удаляем пустые продукты
@@ -90,9 +98,13 @@ def main():
         print(f"[✓] Deleted products: {deleted_count}; re-queued: {len(empty_urls)}")
 
         # все ошибки в pending
-        conn.execute("BEGIN IMMEDIATE;")
-        moved = requeue_all_errors(conn, ts)
-        conn.commit()
+        (n_errors,) = conn.execute(f"SELECT COUNT(*) FROM queue WHERE status={STATUS_ERROR}").fetchone()
+        (n_total,) = conn.execute("SELECT COUNT(*) FROM queue").fetchone()
+        bulk = n_errors >= BULK_REQUEUE_MIN_ROWS and n_errors > n_total * BULK_REQUEUE_MIN_SHARE
+        with bulk_indexes(conn, "queue") if bulk else nullcontext():
+            conn.execute("BEGIN IMMEDIATE;")
+            moved = requeue_all_errors(conn, ts)
+            conn.commit()
         print(f"[✓] Re-queued from error: {moved}")
         print("[✓] Done.")
     finally:
@@ -0,0 +1,28 @@
+from selectolax.lexbor import LexborHTMLParser
+
+from parse import extract_fitment_table, node_text
+
+
+FITMENT_HTML = """
+<div class="fitment-container"><div class="applications-container"><table><tbody>
+  <tr>
+    <td class="application-content">2010 Ford<br>F-150</td>
+    <td class="application-content"><span>XL</span> <b>Crew Cab</b></td>
+    <td class="application-content"><div>4 Cyl</div><div>2.0L</div></td>
+  </tr>
+</tbody></table></div></div>
+"""
+
+
+def test_node_text_breaks_on_br_and_blocks():
+    tree = LexborHTMLParser(FITMENT_HTML)
+    assert extract_fitment_table(tree) == [
+        {"vehicle": "2010 Ford\nF-150", "sub_model": "XL Crew Cab", "engine": "4 Cyl\n2.0L"},
+    ]
+
+
+def test_node_text_skips_script_and_style():
+    tree = LexborHTMLParser(
+        "<div id='x'>  Brand:\n  <script>var a = 1;</script><style>b{}</style> Bosch </div>"
+    )
+    assert node_text(tree.css_first("#x")) == "Brand: Bosch"